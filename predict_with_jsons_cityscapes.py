@@ -13,13 +13,20 @@
 # limitations under the License.
 
 import os
-import math
 import json
 import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
 import cv2
 import numpy as np
 import paddle
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 from paddleseg import utils
 from paddleseg.core import infer
 from eiseg.util.polygon import get_polygon
@@ -53,6 +60,37 @@ def parse_args():
         default='gpu',
         choices=['cpu', 'gpu', 'xpu', 'npu', 'mlu'],
         type=str)
+    parser.add_argument(
+        '--num_workers',
+        help='The number of processes for post-processing (polygonization and image '
+        'saving). 1 means a background thread in the main process.',
+        type=int,
+        default=max(1, (os.cpu_count() or 2) - 1))
+    parser.add_argument(
+        '--batch_size',
+        help='The number of images fed to the model in one forward pass. '
+        'Batching is skipped when `--aug_pred` is on, since mixed scales cannot be '
+        'stacked, and when `--is_slide` is on, since sliding-window aggregation '
+        'only supports one image per pass.',
+        type=int,
+        default=1)
+    parser.add_argument(
+        '--fast_polygon',
+        help='Extract polygons with a pure-OpenCV contour chain instead of '
+        'eiseg\'s get_polygon. Faster, but the simplified outlines differ slightly.',
+        action='store_true')
+    parser.add_argument(
+        '--use_predictor',
+        help='Export the model once and run it through the static-graph Paddle '
+        'Inference engine instead of dygraph. Ignored with `--aug_pred` or `--is_slide`.',
+        action='store_true')
+    parser.add_argument(
+        '--precision',
+        help='The inference precision when `--use_predictor` is on. fp16 requires '
+        'a TensorRT-enabled Paddle build.',
+        default='fp32',
+        choices=['fp32', 'fp16'],
+        type=str)
 
     # Data augment params
     parser.add_argument(
@@ -118,49 +156,164 @@ def merge_test_config(cfg, args):
         test_config['custom_color'] = args.custom_color
     return test_config
 
+_created_dirs = set()
+
+
 def mkdir(path):
+    # called for every saved file; most images share a city subdir, so
+    # memoize to avoid two filesystem hits per call
     sub_dir = os.path.dirname(path)
-    if not os.path.exists(sub_dir):
-        os.makedirs(sub_dir)
+    if sub_dir not in _created_dirs:
+        os.makedirs(sub_dir, exist_ok=True)
+        _created_dirs.add(sub_dir)
 
 
 def partition_list(arr, m):
-    """split the list 'arr' into m pieces"""
-    n = int(math.ceil(len(arr) / float(m)))
-    return [arr[i:i + n] for i in range(0, len(arr), n)]
+    """split the list 'arr' into m pieces balanced by file size
 
+    A contiguous split leaves ranks idle once their chunk is done, since
+    scene complexity (and so polygonization cost) varies a lot between
+    images. File size is a cheap proxy for that cost: sort descending and
+    greedy-assign each file to the currently lightest rank.
+    """
+    sizes = {path: os.path.getsize(path) for path in arr}
+    parts = [[] for _ in range(m)]
+    loads = [0] * m
+    for path in sorted(arr, key=sizes.get, reverse=True):
+        rank = loads.index(min(loads))
+        parts[rank].append(path)
+        loads[rank] += sizes[path]
+    return parts
 
-def preprocess(im_path, transforms):
+
+def preprocess(im_path, transforms, as_tensor=True):
     data = {}
-    data['img'] = im_path
+    # decode once and keep the raw BGR frame, so visualization does not
+    # pay a second imread/PNG decode on the same file
+    raw = cv2.imread(im_path)
+    data['img'] = raw
     data = transforms(data)
     data['img'] = data['img'][np.newaxis, ...]
-    data['img'] = paddle.to_tensor(data['img'])
+    if not as_tensor:
+        # the static-graph predictor copies from host arrays, so moving
+        # the image to the device here would be a pointless round trip
+        pass
+    elif paddle.device.get_device().startswith('gpu'):
+        # stage through pinned host memory so the H2D copy is asynchronous
+        # and can overlap with the forward pass still running on device
+        pinned = paddle.to_tensor(data['img'], place=paddle.CUDAPinnedPlace())
+        data['img'] = pinned.cuda(blocking=False)
+    else:
+        data['img'] = paddle.to_tensor(data['img'])
+    data['raw'] = raw
     return data
 
 
-# convert various types of data into JSON format
+# Cityscapes train ids and their official colors; ids double as the
+# category_id values written to the annotation JSON. "background" is
+# deliberately absent, EISeg treats unlabeled pixels as background.
+_CITYSCAPES_CATEGORIES = (
+    ("road", (128, 64, 128)),
+    ("sidewalk", (244, 35, 232)),
+    ("building", (70, 70, 70)),
+    ("wall", (102, 102, 156)),
+    ("fence", (190, 153, 153)),
+    ("pole", (153, 153, 153)),
+    ("traffic_light", (250, 170, 30)),
+    ("traffic_sign", (220, 220, 0)),
+    ("vegetation", (107, 142, 35)),
+    ("terrain", (152, 251, 152)),
+    ("sky", (70, 130, 180)),
+    ("person", (220, 20, 60)),
+    ("rider", (255, 0, 0)),
+    ("car", (0, 0, 142)),
+    ("truck", (0, 0, 70)),
+    ("bus", (0, 60, 100)),
+    ("train", (0, 80, 100)),
+    ("motorcycle", (0, 0, 230)),
+    ("bicycle", (119, 11, 32)),
+)
+
+
+# convert various types of data into JSON format; only used when orjson
+# is not installed
 class NpEncoder(json.JSONEncoder):
+    # exact-type dispatch avoids walking numpy's abstract-class hierarchy
+    # with isinstance for every scalar in the polygon points
+    _dispatch = {
+        np.ndarray: np.ndarray.tolist,
+        np.int32: int,
+        np.int64: int,
+        np.uint8: int,
+        np.float32: float,
+        np.float64: float,
+    }
+
     def default(self, obj):
-        if isinstance(obj, np.integer):
-            return int(obj)
-        elif isinstance(obj, np.floating):
-            return float(obj)
-        elif isinstance(obj, np.ndarray):
-            return obj.tolist()
-        elif isinstance(obj, datetime.datetime):
-            return obj.strftime('%Y-%m-%dT%H:%M:%S')
-        else:
-            return super(NpEncoder, self).default(obj)
+        fn = self._dispatch.get(type(obj))
+        if fn is not None:
+            return fn(obj)
+        return super(NpEncoder, self).default(obj)
+
+
+# beyond this many images, annotations are streamed to an NDJSON sidecar
+# instead of accumulating in RAM until the final dump
+_STREAM_ANNOTATIONS_THRESHOLD = 200
 
 
-def get_polygons_for_all_classes(pred, img_size):
+def _dump_json_bytes(obj):
+    if orjson is not None:
+        return orjson.dumps(
+            obj,
+            option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, cls=NpEncoder).encode("utf-8")
+
+
+def _extract_polygons(class_mask, img_size):
+    """Extract simplified contours for one class mask with OpenCV only.
+
+    eiseg's get_polygon post-processes every contour vertex in Python;
+    here findContours and approxPolyDP keep the whole chain in OpenCV's
+    C++ kernels and the vertices come back as ndarrays ready to flatten.
+    The simplification tolerance scales with the contour length, so the
+    output is close to, but not bit-identical with, EISeg's.
+    """
+    contours, _ = cv2.findContours(class_mask, cv2.RETR_EXTERNAL,
+                                   cv2.CHAIN_APPROX_TC89_L1)
+    polygons = []
+    for contour in contours:
+        if len(contour) < 3:
+            continue
+        epsilon = 0.0005 * cv2.arcLength(contour, True)
+        approx = cv2.approxPolyDP(contour, epsilon, True)
+        if len(approx) < 3:
+            continue
+        polygons.append(approx.reshape(-1, 2))
+    return polygons or None
+
+
+def get_polygons_for_all_classes(pred, img_size, fast=False):
     all_polygons = {}  # 初始化存储所有类别多边形的字典
 
-    for class_id in range(19):  # 假设有19个类别
+    # one linear scan counts pixels per label; classes with zero pixels
+    # never reach get_polygon, and ids past 18 (the 255 ignore label) are
+    # dropped by the slice
+    counts = np.bincount(pred.ravel(), minlength=19)
+    present = np.nonzero(counts[:19])[0].astype(pred.dtype)
+    if present.size == 0:  # nothing but ignore label in this frame
+        return all_polygons
+
+    # one broadcast compare builds the binary planes for every present
+    # class in a single pass over the prediction
+    mask_stack = np.equal(pred[None], present[:, None, None]).view(np.uint8)
+    class_mask = np.empty(pred.shape, dtype=np.uint8)
+    for class_id, plane in zip(present, mask_stack):
         # 创建二值图像，前景为255，背景为0
-        class_mask = np.where(pred == class_id, 255, 0).astype(np.uint8)
-        class_polygons = get_polygon(class_mask, img_size=img_size, building=False)  # 获取当前类别的多边形轮廓
+        np.multiply(plane, 255, out=class_mask)
+        if fast:
+            class_polygons = _extract_polygons(class_mask, img_size)
+        else:
+            class_polygons = get_polygon(class_mask, img_size=img_size, building=False)  # 获取当前类别的多边形轮廓
         if class_polygons is not None:  # 检查class_polygons是否为None
             if class_id not in all_polygons:
                 all_polygons[class_id] = []  # 如果字典中还没有这个类别，则初始化一个空列表
@@ -169,6 +322,160 @@ def get_polygons_for_all_classes(pred, img_size):
     return all_polygons
 
 
+def _create_predictor(model, save_dir, precision):
+    """Export the loaded dygraph model and build a Paddle Inference predictor.
+
+    The static graph drops per-op Python dispatch and enables fused
+    kernels; with precision='fp16' the TensorRT engine additionally halves
+    activation bandwidth. Returns None when export or engine creation
+    fails, so the caller can fall back to the dygraph path.
+    """
+    try:
+        from paddle import inference
+
+        model_prefix = os.path.join(save_dir, 'static_model', 'model')
+        paddle.jit.save(
+            model,
+            model_prefix,
+            input_spec=[
+                paddle.static.InputSpec(
+                    shape=[None, 3, None, None], dtype='float32')
+            ])
+        config = inference.Config(model_prefix + '.pdmodel',
+                                  model_prefix + '.pdiparams')
+        if paddle.device.get_device().startswith('gpu'):
+            config.enable_use_gpu(500, 0)
+            if precision == 'fp16':
+                config.enable_tensorrt_engine(
+                    workspace_size=1 << 30,
+                    precision_mode=inference.PrecisionType.Half,
+                    max_batch_size=8,
+                    min_subgraph_size=3)
+        else:
+            config.disable_gpu()
+        config.enable_memory_optim()
+        return inference.create_predictor(config)
+    except Exception as e:
+        logger.warning('Failed to build the static predictor ({}), '
+                       'falling back to dygraph inference.'.format(e))
+        return None
+
+
+def _run_predictor(predictor, batch_np):
+    """Run one forward pass through the inference engine and return the logits."""
+    input_handle = predictor.get_input_handle(predictor.get_input_names()[0])
+    input_handle.copy_from_cpu(batch_np)
+    predictor.run()
+    output_handle = predictor.get_output_handle(
+        predictor.get_output_names()[0])
+    return output_handle.copy_to_cpu()
+
+
+def _reverse_transform_np(label, trans_info):
+    """Undo the transforms recorded in trans_info on a host label map.
+
+    The host-side twin of infer.reverse_transform for the predictor path,
+    using nearest interpolation since the input is already argmaxed labels.
+    """
+    for item in trans_info[::-1]:
+        trans_mode = item[0][0] if isinstance(item[0], list) else item[0]
+        if trans_mode == 'resize':
+            h, w = item[1][0], item[1][1]
+            label = cv2.resize(label, (w, h),
+                               interpolation=cv2.INTER_NEAREST)
+        elif trans_mode == 'padding':
+            h, w = item[1][0], item[1][1]
+            label = label[0:h, 0:w]
+        else:
+            raise ValueError(
+                "Unexpected info '{}' in trans_info".format(item[0]))
+    return label
+
+
+def _visualize_added(im_bgr, pred, palette_bgr, weight=0.6):
+    """Blend the colorized prediction onto the decoded frame.
+
+    A single fancy index through the (256, 3) BGR palette colorizes the
+    whole prediction, and cv2.addWeighted runs the alpha blend in OpenCV's
+    SIMD kernels. `weight` is the weight of the original image.
+    """
+    color_pred = palette_bgr[pred]
+    return cv2.addWeighted(im_bgr, weight, color_pred, 1 - weight, 0)
+
+
+def _postprocess(pred, i, im_path, raw, image_dir, color_map, palette_bgr,
+                 added_saved_dir, pred_saved_dir, fast_polygon=False):
+    """Copy one prediction to the host, polygonize it and save its visualizations.
+
+    Runs on a worker thread so the D2H copy and the CPU-side polygon/IO work
+    overlap with the next forward pass. Returns the image record and its
+    annotation dicts; annotation ids are filled in by the caller, which
+    collects results in submission order.
+    """
+    if not isinstance(pred, np.ndarray):
+        pred = pred.numpy()
+
+    # 调用函数
+    all_class_polygons = get_polygons_for_all_classes(
+        pred, img_size=pred.shape, fast=fast_polygon)
+
+    # get the saved name
+    if image_dir is not None:
+        im_file = im_path.replace(image_dir, '')
+    else:
+        im_file = os.path.basename(im_path)
+    if im_file[0] == '/' or im_file[0] == '\\':
+        im_file = im_file[1:]
+
+    # save added image, reusing the frame decoded during preprocessing
+    added_image = _visualize_added(raw, pred, palette_bgr, weight=0.6)
+    added_image_path = os.path.join(added_saved_dir, im_file)
+    mkdir(added_image_path)
+    # DEFLATE level 1 halves the encode time over the default and these
+    # previews do not need the extra few percent of compression
+    cv2.imwrite(added_image_path, added_image,
+                [cv2.IMWRITE_PNG_COMPRESSION, 1])
+
+    # save pseudo color prediction
+    pred_mask = utils.visualize.get_pseudo_color_map(pred, color_map)
+    pred_saved_path = os.path.join(
+        pred_saved_dir, os.path.splitext(im_file)[0] + ".png")
+    mkdir(pred_saved_path)
+    pred_mask.save(pred_saved_path, optimize=False, compress_level=1)
+
+    # define the information required for a single image
+    image = {
+        "id": i + 1,
+        "width": pred.shape[1],
+        "height": pred.shape[0],
+        "file_name": im_file,
+        "license": "",
+        "flickr_url": "",
+        "coco_url": "",
+        "date_captured": ""
+    }
+
+    image_annotations = []
+    for class_id, class_polygons in all_class_polygons.items():
+        # 对于每一类，处理其多边形轮廓
+        for polygon in class_polygons:
+            # 将多边形的每个点处理成连续的列表形式
+            # one C-level flatten instead of a Python double loop per vertex
+            segmentation = np.asarray(polygon).reshape(-1).tolist()
+
+            # 创建annotation字典，不计算面积和边界框
+            annotation = {
+                "id": 0,  # 由主线程按收集顺序编号
+                "iscrowd": 0,
+                "image_id": i + 1,
+                "category_id": class_id,
+                "segmentation": [segmentation],  # 使用多边形顶点的扁平列表
+                "area": 0,  # 不计算面积
+                "bbox": []  # 不计算边界框
+            }
+            image_annotations.append(annotation)
+
+    return image, image_annotations
 
 
 def predict(model,
@@ -184,7 +491,12 @@ def predict(model,
             is_slide=False,
             stride=None,
             crop_size=None,
-            custom_color=None):
+            custom_color=None,
+            batch_size=1,
+            num_workers=1,
+            use_predictor=False,
+            precision='fp32',
+            fast_polygon=False):
     """
     predict and visualize the image_list.
 
@@ -205,10 +517,30 @@ def predict(model,
         crop_size (tuple|list, optional):  The crop size of sliding window, the first is width and the second is height.
             It should be provided when `is_slide` is True.
         custom_color (list, optional): Save images with a custom color map. Default: None, use paddleseg's default color map.
+        batch_size (int, optional): The number of images stacked into one forward pass. Batching is
+            skipped when `aug_pred` or `is_slide` is True. Default: 1.
+        num_workers (int, optional): The number of worker processes for post-processing. With 1,
+            post-processing runs on a background thread in the main process. Default: 1.
+        use_predictor (bool, optional): Whether to export the model and run it through the
+            static-graph Paddle Inference engine. Ignored when `aug_pred` or `is_slide` is True,
+            and falls back to dygraph when the export fails. Default: False.
+        precision (str, optional): The precision for the inference engine, 'fp32' or 'fp16'.
+            It is valid when `use_predictor` is True. Default: 'fp32'.
+        fast_polygon (bool, optional): Whether to extract polygons with the pure-OpenCV contour
+            chain instead of eiseg's get_polygon. Default: False.
 
     """
     utils.utils.load_entire_model(model, model_path)
     model.eval()
+
+    predictor = None
+    if use_predictor:
+        if aug_pred or is_slide:
+            logger.warning('--use_predictor does not support aug_pred or '
+                           'is_slide, falling back to dygraph inference.')
+        else:
+            predictor = _create_predictor(model, save_dir, precision)
+
     nranks = paddle.distributed.get_world_size()
     local_rank = paddle.distributed.get_rank()
     if nranks > 1:
@@ -224,176 +556,86 @@ def predict(model,
     logger.info("Start to predict...")
     progbar_pred = progbar.Progbar(target=len(img_lists[0]), verbose=1)
     color_map = visualize.get_color_map_list(256, custom_color=custom_color)
+    # (256, 3) BGR lookup table shared by all visualizations
+    palette_bgr = np.asarray(
+        color_map, dtype=np.uint8).reshape(-1, 3)[:, ::-1]
     with paddle.no_grad():
         # define the nodes required for JSON, including images, colors, etc
         images = []
         annotations = []
-        categories = []
-        # Already existing categories
-        # background_color = {
-        #     "id": 0,
-        #     "name": "background",
-        #     "color": [0, 0, 0],
-        #     "supercategory": "",
-        # }
-        # categories.append(background_color)
-        road_color = {
-            "id": 0,
-            "name": "road",
-            "color": [128, 64, 128],
-            "supercategory": "",
-        }
-        categories.append(road_color)
-
-        sidewalk_color = {
-            "id": 1,
-            "name": "sidewalk",
-            "color": [244, 35, 232],
-            "supercategory": "",
-        }
-        categories.append(sidewalk_color)
-
-        building_color = {
-            "id": 2,
-            "name": "building",
-            "color": [70, 70, 70],
+        categories = [{
+            "id": class_id,
+            "name": name,
+            "color": list(color),
             "supercategory": "",
-        }
-        categories.append(building_color)
-
-        wall_color = {
-            "id": 3,
-            "name": "wall",
-            "color": [102, 102, 156],
-            "supercategory": "",
-        }
-        categories.append(wall_color)
-
-        # Adding new categories
-        fence_color = {
-            "id": 4,
-            "name": "fence",
-            "color": [190, 153, 153],
-            "supercategory": "",
-        }
-        categories.append(fence_color)
-
-        pole_color = {
-            "id": 5,
-            "name": "pole",
-            "color": [153, 153, 153],
-            "supercategory": "",
-        }
-        categories.append(pole_color)
-
-        traffic_light_color = {
-            "id": 6,
-            "name": "traffic_light",
-            "color": [250, 170, 30],
-            "supercategory": "",
-        }
-        categories.append(traffic_light_color)
-
-        traffic_sign_color = {
-            "id": 7,
-            "name": "traffic_sign",
-            "color": [220, 220, 0],
-            "supercategory": "",
-        }
-        categories.append(traffic_sign_color)
-
-        vegetation_color = {
-            "id": 8,
-            "name": "vegetation",
-            "color": [107, 142, 35],
-            "supercategory": "",
-        }
-        categories.append(vegetation_color)
-
-        terrain_color = {
-            "id": 9,
-            "name": "terrain",
-            "color": [152, 251, 152],
-            "supercategory": "",
-        }
-        categories.append(terrain_color)
-
-        sky_color = {
-            "id": 10,
-            "name": "sky",
-            "color": [70, 130, 180],
-            "supercategory": "",
-        }
-        categories.append(sky_color)
-
-        person_color = {
-            "id": 11,
-            "name": "person",
-            "color": [220, 20, 60],
-            "supercategory": "",
-        }
-        categories.append(person_color)
-
-        rider_color = {
-            "id": 12,
-            "name": "rider",
-            "color": [255, 0, 0],
-            "supercategory": "",
-        }
-        categories.append(rider_color)
-
-        car_color = {
-            "id": 13,
-            "name": "car",
-            "color": [0, 0, 142],
-            "supercategory": "",
-        }
-        categories.append(car_color)
-
-        truck_color = {
-            "id": 14,
-            "name": "truck",
-            "color": [0, 0, 70],
-            "supercategory": "",
-        }
-        categories.append(truck_color)
-
-        bus_color = {
-            "id": 15,
-            "name": "bus",
-            "color": [0, 60, 100],
-            "supercategory": "",
-        }
-        categories.append(bus_color)
-
-        train_color = {
-            "id": 16,
-            "name": "train",
-            "color": [0, 80, 100],
-            "supercategory": "",
-        }
-        categories.append(train_color)
-
-        motorcycle_color = {
-            "id": 17,
-            "name": "motorcycle",
-            "color": [0, 0, 230],
-            "supercategory": "",
-        }
-        categories.append(motorcycle_color)
-
-        bicycle_color = {
-            "id": 18,
-            "name": "bicycle",
-            "color": [119, 11, 32],
-            "supercategory": "",
-        }
-        categories.append(bicycle_color)
+        } for class_id, (name, color) in enumerate(_CITYSCAPES_CATEGORIES)]
+
+        img_list = img_lists[local_rank]
+        # slide_inference aggregates logits into a batch-1 buffer, so
+        # sliding-window prediction must stay one image per forward pass
+        infer_batch_size = 1 if is_slide else batch_size
+        batch_indices = []
+        batch_paths = []
+        batch_raws = []
+        batch_imgs = []
+        batch_trans_info = []
+        # post-processing is embarrassingly parallel across images: with
+        # num_workers > 1 it fans out to a process pool so polygonization
+        # and PNG encoding use all cores, otherwise a background thread
+        # still hides the D2H copy under the next forward pass; the queue
+        # of in-flight futures is bounded to cap resident predictions
+        use_processes = num_workers > 1
+        if use_processes:
+            pool = ProcessPoolExecutor(max_workers=num_workers)
+            inflight_limit = num_workers + 2
+        else:
+            pool = ThreadPoolExecutor(max_workers=2)
+            inflight_limit = 3
+        inflight = deque()
+
+        # a full Cityscapes run can hold hundreds of MB of polygon points
+        # before the final dump; past the threshold each image's
+        # annotations go straight to an NDJSON sidecar and are spliced
+        # into the final JSON at the end, keeping the resident list small
+        stream_annotations = len(img_list) > _STREAM_ANNOTATIONS_THRESHOLD
+        ann_stream = None
+        if stream_annotations:
+            mkdir(json_saved_name)
+            # rank-local sidecar, so concurrent ranks do not interleave
+            # lines in (and then delete) one shared file
+            sidecar_path = '{}.rank{}.ndjson'.format(json_saved_name,
+                                                     local_rank)
+            ann_stream = open(sidecar_path, 'wb')
+        num_annotations = 0
+
+        def collect(result):
+            # futures are drained oldest-first, so images stay in order
+            nonlocal num_annotations
+            image, image_annotations = result
+            images.append(image)
+            for annotation in image_annotations:
+                num_annotations += 1
+                annotation["id"] = num_annotations  # 自动生成唯一ID
+                if ann_stream is not None:
+                    ann_stream.write(_dump_json_bytes(annotation) + b"\n")
+                else:
+                    annotations.append(annotation)  # 将annotation添加到列表中
 
-        for i, im_path in enumerate(img_lists[local_rank]):
-            data = preprocess(im_path, transforms)
+        # one prefetch thread decodes, transforms and launches the async
+        # H2D copy for the next image while the current batch is inferred
+        prefetch = ThreadPoolExecutor(max_workers=1)
+        data_future = None
+        as_tensor = predictor is None
+        for i, im_path in enumerate(img_list):
+            data = data_future.result() if data_future is not None \
+                else preprocess(im_path, transforms, as_tensor)
+            if i + 1 < len(img_list):
+                data_future = prefetch.submit(preprocess, img_list[i + 1],
+                                              transforms, as_tensor)
 
             if aug_pred:
+                # mixed scales produce intermediates of different sizes,
+                # so augmented prediction stays one image at a time
                 pred, _ = infer.aug_inference(
                     model,
                     data['img'],
@@ -404,95 +646,113 @@ def predict(model,
                     is_slide=is_slide,
                     stride=stride,
                     crop_size=crop_size)
+                batch_preds = [paddle.squeeze(pred).astype('uint8')]
+                batch_items = [(i, im_path)]
+                item_raws = [data['raw']]
             else:
-                pred, _ = infer.inference(
-                    model,
-                    data['img'],
-                    trans_info=data['trans_info'],
-                    is_slide=is_slide,
-                    stride=stride,
-                    crop_size=crop_size)
-            pred = paddle.squeeze(pred)
-            pred = pred.numpy().astype('uint8')
-            # print("pred:")
-            # print(pred)
-            # print(len(pred))
-            # print(len(pred[0]))
-
-            # 调用函数
-            all_class_polygons = get_polygons_for_all_classes(pred, img_size=pred.shape)
-
-            # get the saved name
-            if image_dir is not None:
-                im_file = im_path.replace(image_dir, '')
-            else:
-                im_file = os.path.basename(im_path)
-            if im_file[0] == '/' or im_file[0] == '\\':
-                im_file = im_file[1:]
-
-            # save added image
-            added_image = utils.visualize.visualize(
-                im_path, pred, color_map, weight=0.6)
-            added_image_path = os.path.join(added_saved_dir, im_file)
-            mkdir(added_image_path)
-            cv2.imwrite(added_image_path, added_image)
-
-            # save pseudo color prediction
-            pred_mask = utils.visualize.get_pseudo_color_map(pred, color_map)
-            pred_saved_path = os.path.join(
-                pred_saved_dir, os.path.splitext(im_file)[0] + ".png")
-            mkdir(pred_saved_path)
-            pred_mask.save(pred_saved_path)
-
-            progbar_pred.update(i + 1)
-
-            # define the information required for a single image
-            image = {
-                "id": i + 1,
-                "width": pred.shape[1],
-                "height": pred.shape[0],
-                "file_name": im_file,
-                "license": "",
-                "flickr_url": "",
-                "coco_url": "",
-                "date_captured": ""
+                # accumulate preprocessed tensors and run one forward pass
+                # per batch instead of per image
+                batch_indices.append(i)
+                batch_paths.append(im_path)
+                batch_raws.append(data['raw'])
+                batch_imgs.append(data['img'])
+                batch_trans_info.append(data['trans_info'])
+                if len(batch_imgs) < infer_batch_size and i + 1 < len(img_list):
+                    continue
+                if predictor is not None:
+                    # the inference engine consumes and returns host
+                    # arrays and the exported graph ends at the logits,
+                    # so the argmax and each sample's reverse transform
+                    # run here on the host
+                    batch_np = np.concatenate(batch_imgs, axis=0)
+                    logits = _run_predictor(predictor, batch_np)
+                    labels = np.argmax(logits, axis=1).astype(np.uint8)
+                    batch_preds = [
+                        _reverse_transform_np(labels[j], trans_info)
+                        for j, trans_info in enumerate(batch_trans_info)
+                    ]
+                else:
+                    batch_tensor = paddle.concat(batch_imgs, axis=0)
+                    # with trans_info=None infer.inference returns the raw
+                    # batch logit; the reverse transform restores to each
+                    # image's own original shape, so it runs per sample
+                    # with that sample's trans_info
+                    logit = infer.inference(
+                        model,
+                        batch_tensor,
+                        is_slide=is_slide,
+                        stride=stride,
+                        crop_size=crop_size)
+                    batch_preds = []
+                    for j, trans_info in enumerate(batch_trans_info):
+                        sample_logit = infer.reverse_transform(
+                            logit[j:j + 1], trans_info, mode='bilinear')
+                        sample_pred = paddle.argmax(
+                            sample_logit, axis=1, dtype='int32')
+                        # argmax and the uint8 cast stay on device so the
+                        # D2H copy moves one byte per pixel
+                        batch_preds.append(
+                            paddle.squeeze(sample_pred).astype('uint8'))
+                batch_items = list(zip(batch_indices, batch_paths))
+                item_raws = batch_raws
+                batch_indices = []
+                batch_paths = []
+                batch_raws = []
+                batch_imgs = []
+                batch_trans_info = []
+
+            for (i, im_path), pred, raw in zip(batch_items, batch_preds,
+                                               item_raws):
+                if use_processes and not isinstance(pred, np.ndarray):
+                    # worker processes need a picklable array, not a tensor
+                    pred = pred.numpy()
+                if len(inflight) >= inflight_limit:
+                    collect(inflight.popleft().result())
+                inflight.append(
+                    pool.submit(_postprocess, pred, i, im_path, raw,
+                                image_dir, color_map, palette_bgr,
+                                added_saved_dir, pred_saved_dir,
+                                fast_polygon))
+                progbar_pred.update(i + 1)
+
+        prefetch.shutdown()
+        while inflight:
+            collect(inflight.popleft().result())
+        pool.shutdown()
+
+        if ann_stream is not None:
+            ann_stream.close()
+            # assemble the final JSON by splicing the NDJSON lines into
+            # the annotations array without re-materializing them in RAM
+            with open(json_saved_name, "wb") as f:
+                f.write(b'{"categories":')
+                f.write(_dump_json_bytes(categories))
+                f.write(b',"images":')
+                f.write(_dump_json_bytes(images))
+                f.write(b',"annotations":[')
+                with open(sidecar_path, 'rb') as lines:
+                    for j, line in enumerate(lines):
+                        if j:
+                            f.write(b',')
+                        f.write(line.rstrip(b'\n'))
+                f.write(b'],"info":"","licenses":[]}')
+            os.remove(sidecar_path)
+        else:
+            # summarize all information together to form annotated data
+            json_data = {
+                "categories": [],
+                "images": [],
+                "annotations": [],
+                "info": "",
+                "licenses": [],
             }
-            images.append(image)
-
-            for class_id, class_polygons in all_class_polygons.items():
-                # 对于每一类，处理其多边形轮廓
-                for polygon in class_polygons:
-                    # 将多边形的每个点处理成连续的列表形式
-                    segmentation = [point for sublist in polygon for point in sublist]
-
-                    # 创建annotation字典，不计算面积和边界框
-                    annotation = {
-                        "id": len(annotations) + 1,  # 自动生成唯一ID
-                        "iscrowd": 0,
-                        "image_id": i+1,
-                        "category_id": class_id,
-                        "segmentation": [segmentation],  # 使用多边形顶点的扁平列表
-                        "area": 0,  # 不计算面积
-                        "bbox": []  # 不计算边界框
-                    }
-                    annotations.append(annotation)  # 将annotation添加到列表中
-
-        # summarize all information together to form annotated data
-        json_data = {
-            "categories": [],
-            "images": [],
-            "annotations": [],
-            "info": "",
-            "licenses": [],
-        }
-        json_data["categories"] = categories
-        json_data["images"] = images
-        json_data["annotations"] = annotations
-        # save JSON file
-        open(
-            json_saved_name, "w",
-            encoding="utf-8").write(json.dumps(
-                json_data, cls=NpEncoder))
+            json_data["categories"] = categories
+            json_data["images"] = images
+            json_data["annotations"] = annotations
+            # save JSON file; orjson serializes numpy scalars/arrays
+            # natively instead of calling NpEncoder.default per value
+            with open(json_saved_name, "wb") as f:
+                f.write(_dump_json_bytes(json_data))
 
     logger.info("Predicted images are saved in {} and {} .".format(
         added_saved_dir, pred_saved_dir))
@@ -506,6 +766,21 @@ def main(args):
 
     utils.show_env_info()
     utils.show_cfg_info(cfg)
+
+    # grow allocations on demand instead of reserving a big arena up
+    # front; prediction at batch_size-scale never needs the training-size
+    # workspace, and this cuts peak memory accordingly
+    if args.device == 'gpu':
+        paddle.set_flags({
+            'FLAGS_allocator_strategy': 'auto_growth',
+            'FLAGS_fraction_of_gpu_memory_to_use': 0.0,
+        })
+    else:
+        paddle.set_flags({
+            'FLAGS_allocator_strategy': 'auto_growth',
+            'FLAGS_initial_cpu_memory_in_mb': 500,
+        })
+
     utils.set_device(args.device)
 
     model = builder.model
@@ -520,6 +795,11 @@ def main(args):
         image_list=image_list,
         image_dir=image_dir,
         save_dir=args.save_dir,
+        batch_size=args.batch_size,
+        num_workers=args.num_workers,
+        use_predictor=args.use_predictor,
+        precision=args.precision,
+        fast_polygon=args.fast_polygon,
         **test_config)
 
 if __name__ == '__main__':